@@ -1,117 +1,300 @@
-from flask import Flask, request, render_template, send_file
+from flask import Flask, request, render_template, send_file, abort
+import codecs
 import csv
-from tabulate import tabulate
-from collections import defaultdict
-from openpyxl import Workbook
+import hashlib
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from itertools import repeat
+import numpy as np
+import orjson
 import io
 import os
-import base64  # Add this import
+import re
+import stat
+import threading
+import time
+import uuid
 
 app = Flask(__name__)
+# Reject oversized uploads before they are parsed
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
 
+# Generated Excel files are kept on disk and downloaded by key for EXCEL_TTL seconds.
+# They live in the app's instance folder, not the shared temp dir, so other local users cannot reach them.
+EXCEL_DIR = os.path.join(app.instance_path, 'excel')
+EXCEL_TTL = 15 * 60
 
-def safe_str(val):
-    """Convert value to string safely, handling lists and None."""
-    if isinstance(val, list):
-        return safe_str(val[0]) if val else ''
-    if val is None:
-        return ''
-    return str(val).strip()
+# Results of recent uploads, keyed on (file digest, stock length, kerf, encoding), least recently used first
+RESULT_CACHE = OrderedDict()
+RESULT_CACHE_SIZE = 32
+RESULT_CACHE_LOCK = threading.Lock()
 
+# Largest length or quantity that fits the int64 part columns
+INT64_MAX = 2 ** 63 - 1
 
-def try_decode_file(file_content, encodings=['utf-8-sig', 'latin1', 'windows-1252', 'iso-8859-1']):
-    """Attempt to decode file content with multiple encodings."""
+
+# Byte order marks and the codecs that decode (and drop) them; UTF-32 LE must be checked before UTF-16 LE
+BOM_ENCODINGS = [(codecs.BOM_UTF8, 'utf-8-sig'),
+                 (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+                 (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+
+
+def detect_encoding(prefix, encodings=['utf-8-sig', 'latin1', 'windows-1252', 'iso-8859-1']):
+    """Pick the encoding of a file from its byte order mark, or else the first
+    encoding that can decode its leading bytes."""
+    for bom, encoding in BOM_ENCODINGS:
+        if prefix.startswith(bom):
+            return encoding
+
+    error = None
     for encoding in encodings:
         try:
-            return file_content.decode(encoding), encoding
-        except UnicodeDecodeError:
+            # Incremental decode so a multi-byte character cut off at the end of the prefix is not an error
+            codecs.getincrementaldecoder(encoding)().decode(prefix, final=False)
+            return encoding
+        except UnicodeDecodeError as e:
+            error = e
+    raise error
+
+
+def excel_path(excel_key):
+    """Return the on-disk path of a generated Excel file."""
+    return os.path.join(EXCEL_DIR, f"{excel_key}.xlsx")
+
+
+def ensure_excel_dir():
+    """Create EXCEL_DIR readable only by this user, refusing a directory someone else controls."""
+    os.makedirs(EXCEL_DIR, mode=0o700, exist_ok=True)
+    st = os.lstat(EXCEL_DIR)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise RuntimeError(f'{EXCEL_DIR} is not a directory owned by the current user')
+    if st.st_mode & 0o077:
+        os.chmod(EXCEL_DIR, 0o700)
+
+
+def prune_excel_files():
+    """Delete generated Excel files older than EXCEL_TTL."""
+    ensure_excel_dir()
+    cutoff = time.time() - EXCEL_TTL
+    for entry in os.scandir(EXCEL_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            # Already removed by another worker
             continue
-    raise UnicodeDecodeError("Unable to decode file with available encodings")
 
 
-def read_csv_parts(csv_content):
-    """Read part info including Weight(kg/m) from CSV content."""
-    parts = []
+def file_digest(stream):
+    """Return a blake2b digest of a binary stream, leaving the stream rewound."""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: stream.read(65536), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.digest()
+
+
+def get_cached_results(cache_key):
+    """Return the cached results for an upload, or None if absent or its Excel file has expired."""
+    with RESULT_CACHE_LOCK:
+        results = RESULT_CACHE.get(cache_key)
+        if results is None:
+            return None
+        try:
+            # Keep the Excel file around for another EXCEL_TTL
+            os.utime(excel_path(results['excel_key']))
+        except OSError:
+            del RESULT_CACHE[cache_key]
+            return None
+        RESULT_CACHE.move_to_end(cache_key)
+        return results
+
+
+def cache_results(cache_key, results):
+    """Store the results for an upload, evicting the least recently used entry when full."""
+    with RESULT_CACHE_LOCK:
+        RESULT_CACHE[cache_key] = results
+        RESULT_CACHE.move_to_end(cache_key)
+        if len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+            RESULT_CACHE.popitem(last=False)
+
+
+def read_upload_parts(stream, encodings):
+    """Decode and parse an uploaded CSV stream, returning (parts, encoding used).
+
+    The first encoding is guessed from a bounded prefix. The file is then decoded
+    strictly while it is parsed; if a later byte does not fit, the stream is
+    rewound and parsed again with the next encoding.
+    """
+    prefix = stream.read(65536)
+    stream.seek(0)
+    detected = detect_encoding(prefix, encodings)
+    error = None
+    for encoding in [detected] + [e for e in encodings if e != detected]:
+        stream.seek(0)
+        csv_text = io.TextIOWrapper(stream, encoding=encoding, newline='')
+        try:
+            return read_csv_parts(csv.reader(csv_text, delimiter=';')), encoding
+        except UnicodeDecodeError as e:
+            error = e
+        finally:
+            csv_text.detach()
+    raise error
+
+
+def read_csv_parts(rows):
+    """Read part info including Weight(kg/m) from parsed CSV rows (e.g. a csv.reader).
+
+    Returns parallel columns (profiles, lengths, demands, weights): a list of profile
+    names and typed arrays for the numbers, which NumPy can view without copying.
+    """
+    profiles = []
+    lengths = array('q')
+    demands = array('q')
+    weights = array('d')
+    parts = (profiles, lengths, demands, weights)
     try:
-        reader = csv.DictReader(csv_content.splitlines(), delimiter=';')
+        reader = iter(rows)
+        header = next(reader, None)
+        if header is None:
+            return parts
+        # Resolve the column positions once and only touch the fields that are used
+        idx = {name.strip(): i for i, name in enumerate(header)}
+        i_size, i_grade, i_len, i_qty, i_w = (idx.get(name) for name in
+                                              ('Size', 'Grade', 'Length(mm)', 'Quantity', 'Weight(kg/m)'))
+        if i_len is None or i_qty is None:
+            return parts
         for row in reader:
-            if not any(row.values()):
-                continue
-            row_stripped = {safe_str(k): safe_str(v) for k, v in row.items()}
-            profile = f"{row_stripped.get('Size', '')}_{row_stripped.get('Grade', '')}"
-            if not profile or profile == '_':
+            if not any(row):
                 continue
             try:
-                length_val = int(row_stripped.get('Length(mm)', 0))
-                demand_val = int(row_stripped.get('Quantity', 0))
-                weight_per_m = float(row_stripped.get('Weight(kg/m)', 0))
-            except ValueError:
+                size = row[i_size].strip() if i_size is not None else ''
+                grade = row[i_grade].strip() if i_grade is not None else ''
+                length_val = int(row[i_len])
+                demand_val = int(row[i_qty])
+                weight_per_m = float(row[i_w]) if i_w is not None else 0.0
+            except (ValueError, IndexError):
+                continue
+            profile = f"{size}_{grade}"
+            if profile == '_':
                 continue
-            if length_val <= 0 or demand_val <= 0:
+            # Values outside int64 cannot be stored in the typed columns; skip the row like any other bad value
+            if not (0 < length_val <= INT64_MAX and 0 < demand_val <= INT64_MAX):
                 continue
-            parts.append((profile, length_val, demand_val, weight_per_m))
+            profiles.append(profile)
+            lengths.append(length_val)
+            demands.append(demand_val)
+            weights.append(weight_per_m)
         return parts
+    except UnicodeDecodeError:
+        # Let the caller retry the upload with another encoding
+        raise
     except Exception:
         return None
 
 
-def best_fit_cutting_stock(parts, stock_length, cut_kerf=0.0):
-    """Best-Fit cutting algorithm."""
-    items = []
-    for profile, length, demand, _ in parts:
-        items.extend([(profile, length)] * demand)
-    items.sort(key=lambda x: x[1], reverse=True)
-
-    bins = []
-    for profile, length in items:
-        effective_length = length + cut_kerf
-        best_bin = None
-        min_remaining = float('inf')
-
-        for bin in bins:
-            if bin['remaining'] >= effective_length:
-                remaining_after = bin['remaining'] - effective_length
-                if remaining_after < min_remaining:
-                    min_remaining = remaining_after
-                    best_bin = bin
-
-        if best_bin:
-            best_bin['remaining'] -= effective_length
-            best_bin['cuts'].append((profile, length))
-        else:
-            bins.append({
-                'remaining': stock_length - effective_length,
-                'cuts': [(profile, length)]
-            })
-    return bins
+def fresh_bin_remaining(stock_length, effective_length, demand):
+    """Remaining length of a fresh bin after each successive cut, up to its capacity or the demand.
+
+    Uses repeated subtraction, so the values match placing the pieces one at a time.
+    """
+    fresh = [stock_length - effective_length]
+    while len(fresh) < demand and fresh[-1] >= effective_length:
+        fresh.append(fresh[-1] - effective_length)
+    return fresh
+
+
+def best_fit_cutting_stock(profiles, lengths, demands, stock_length, cut_kerf=0.0):
+    """Best-Fit cutting algorithm.
+
+    profiles, lengths and demands are parallel sequences describing the part rows.
 
+    Open bins are tracked in a list of (remaining, bin index) pairs kept sorted
+    by remaining length, so the tightest bin that still fits an item is found
+    with a binary search instead of a scan over every bin.
 
-def generate_pattern_details_table(bins, stock_length):
+    Each distinct size is packed as one run of its total demand instead of being
+    expanded into one item per piece. Once no open bin fits the size, the rest of
+    the run fills fresh bins one after another, so those bins are opened in bulk.
+    A profile with a single part length is therefore laid out without any search.
+
+    Bins are returned as two parallel lists: the remaining length of each bin
+    and the (profile, length) cuts placed in it.
+    """
+    # Runs of (cut, total demand), longest first; adjacent rows of the same size are merged
+    sizes = []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True):
+        cut = (profiles[i], lengths[i])
+        if sizes and sizes[-1][0] == cut:
+            sizes[-1][1] += demands[i]
+        else:
+            sizes.append([cut, demands[i]])
+
+    remaining_per_bin = []
+    cuts_per_bin = []
+    slots = []
+    # Bound once outside the hot loop
+    pop_slot = slots.pop
+    for cut, demand in sizes:
+        effective_length = cut[1] + cut_kerf
+        while demand:
+            # First slot with remaining >= effective_length; ties go to the oldest bin
+            pos = bisect_left(slots, (effective_length, -1))
+            if pos == len(slots):
+                break
+            remaining, index = pop_slot(pos)
+            remaining -= effective_length
+            remaining_per_bin[index] = remaining
+            cuts_per_bin[index].append(cut)
+            insort(slots, (remaining, index))
+            demand -= 1
+
+        if not demand:
+            continue
+        fresh = fresh_bin_remaining(stock_length, effective_length, demand)
+        per_bin = len(fresh)
+        full_bins, last_count = divmod(demand, per_bin)
+        counts = [per_bin] * full_bins + ([last_count] if last_count else [])
+        for count in counts:
+            slots.append((fresh[count - 1], len(remaining_per_bin)))
+            remaining_per_bin.append(fresh[count - 1])
+            cuts_per_bin.append([cut] * count)
+        slots.sort()
+    return remaining_per_bin, cuts_per_bin
+
+
+def generate_pattern_details_table(remaining_per_bin, cuts_per_bin, stock_length):
     """Generate cutting pattern details."""
     headers = ['Pattern Name', 'Pattern Length (mm)', 'Cut Details', 'Remaining Waste (mm)']
     table_data = []
-    for i, bin in enumerate(bins, 1):
+    for i, (remaining_waste, cuts) in enumerate(zip(remaining_per_bin, cuts_per_bin), 1):
         pattern_name = f"Pattern {i}"
-        total_length = sum(length for _, length in bin['cuts'])
-        cut_details = ' + '.join(f"1x {profile}({length}mm)" for profile, length in bin['cuts'])
-        remaining_waste = bin['remaining']
+        cut_details = ' + '.join([f"1x {profile}({length}mm)" for profile, length in cuts])
         pattern_length = stock_length - remaining_waste
         table_data.append([pattern_name, pattern_length, cut_details, remaining_waste])
     return table_data, headers
 
 
-def generate_final_report(parts, bins, stock_length, cut_kerf=0.0, profile=None):
-    """Generate summary report with specified formats and weight calculations."""
-    total_stocks_used = len(bins)
+def generate_final_report(profile, lens, demands, weight_per_m, total_stocks_used, stock_length, cut_kerf=0.0):
+    """Generate summary report with specified formats and weight calculations.
+
+    lens and demands are int64 arrays holding the part lengths and quantities of the profile.
+    """
     total_stock_consumed_mm = total_stocks_used * stock_length
-    effective_usage_mm = sum(length * demand for _, length, demand, _ in parts)
-    waste_mm = total_stock_consumed_mm - effective_usage_mm - cut_kerf * sum(demand for _, _, demand, _ in parts)
+    # int64 reductions wrap silently on overflow, so use Python ints if the total could leave the int64 range
+    if float(np.dot(lens.astype(np.float64), demands)) < 2 ** 62:
+        effective_usage_mm = int((lens * demands).sum())
+        total_demand = int(demands.sum())
+    else:
+        effective_usage_mm = sum(length * demand for length, demand in zip(lens.tolist(), demands.tolist()))
+        total_demand = sum(demands.tolist())
+    waste_mm = total_stock_consumed_mm - effective_usage_mm - cut_kerf * total_demand
 
     total_stock_consumed_m = total_stock_consumed_mm / 1000
     effective_usage_m = effective_usage_mm / 1000
     waste_m = waste_mm / 1000
 
-    weight_per_m = parts[0][3]
     total_order_weight_kg = total_stock_consumed_m * weight_per_m if weight_per_m > 0 else 0
     effective_weight_kg = effective_usage_m * weight_per_m if weight_per_m > 0 else 0
     waste_weight_kg = waste_m * weight_per_m if weight_per_m > 0 else 0
@@ -119,13 +302,48 @@ def generate_final_report(parts, bins, stock_length, cut_kerf=0.0, profile=None)
     headers = ['Profile', 'Total Stocks Used', 'Stock Length (mm)', 'Weight (kgm)',
                'Total Usage (m)', 'Effective Usage (m)', 'Waste (m)',
                'Total Order Weight (kg)', 'Effective Weight (kg)', 'Waste Weight (kg)']
-    table_data = [[profile if profile else parts[0][0],
+    table_data = [[profile,
                    total_stocks_used, stock_length, weight_per_m,
                    total_stock_consumed_m, effective_usage_m, waste_m,
                    total_order_weight_kg, effective_weight_kg, waste_weight_kg]]
     return table_data, headers
 
 
+def process_profile(profile, lens, demands, weight_per_m, stock_length, cut_kerf=0.0):
+    """Pack the parts of one profile and build its report and pattern details tables.
+
+    lens and demands are int64 arrays holding the part lengths and quantities of the profile.
+    """
+    # Generate cutting patterns using best-fit algorithm
+    remaining_per_bin, cuts_per_bin = best_fit_cutting_stock([profile] * len(lens), lens.tolist(), demands.tolist(),
+                                                             stock_length, cut_kerf)
+    # Generate final report for this profile
+    agg_table, agg_headers = generate_final_report(profile, lens, demands, weight_per_m,
+                                                   len(remaining_per_bin), stock_length, cut_kerf)
+    # Generate pattern details table
+    details_table, det_headers = generate_pattern_details_table(remaining_per_bin, cuts_per_bin, stock_length)
+    return agg_table, agg_headers, details_table, det_headers
+
+
+def results_payload(results):
+    """Serialize the report tables to JSON that is safe to embed in a <script> element.
+
+    Cells are sent as the strings the server-rendered tables show (e.g. 6.0, not 6),
+    so both views display the same values.
+    """
+    payload = orjson.dumps({'final_headers': results['final_headers'],
+                            'final_data': [[str(cell) for cell in row] for row in results['final_data']],
+                            'details_headers': results['details_headers'],
+                            'details_data': [[str(cell) for cell in row] for row in results['details_data']]})
+    # '<', '>' and '&' only occur inside JSON strings, where the escapes decode to the same text
+    return payload.replace(b'<', b'\\u003c').replace(b'>', b'\\u003e').replace(b'&', b'\\u0026').decode('utf-8')
+
+
+def render_results(results):
+    """Render the results page; tables are drawn client-side unless render=html was requested."""
+    return render_template('results.html', render_html=request.values.get('render') == 'html', **results)
+
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     """
@@ -161,16 +379,18 @@ def index():
         encodings = [selected_encoding] + [e for e in ['utf-8-sig', 'latin1', 'windows-1252', 'iso-8859-1'] if
                                            e != selected_encoding]
 
+        # Identical resubmissions (same file and settings) reuse the previous results
+        cache_key = (file_digest(file.stream), stock_length, cut_kerf, selected_encoding)
+        results = get_cached_results(cache_key)
+        if results:
+            return render_results(results)
+
         try:
-            # Read the uploaded file as bytes
-            file_content = file.read()
-            # Try to decode with selected encodings
-            csv_content, used_encoding = try_decode_file(file_content, encodings)
-            # Parse CSV content into parts
-            parts = read_csv_parts(csv_content)
+            # Decode and parse the upload as a stream, without holding a decoded copy in memory
+            parts, used_encoding = read_upload_parts(file.stream, encodings)
 
             # Check if parsing succeeded
-            if not parts:
+            if not parts or not parts[0]:
                 return render_template('index.html',
                                        error=f'Failed to parse CSV file (tried encoding: {used_encoding})')
         except UnicodeDecodeError as e:
@@ -180,10 +400,22 @@ def index():
             return render_template('index.html',
                                    error=f'Error processing file: {str(e)}')
 
-        # Group parts by profile
-        parts_by_profile = defaultdict(list)
-        for part in parts:
-            parts_by_profile[part[0]].append(part)
+        # Group rows by profile: np.unique gives the sorted profile names and each row's group,
+        # and a stable sort by group keeps the rows of a profile in file order
+        profiles, lengths, demands, weights = parts
+        profile_names, group_of_row, group_sizes = np.unique(np.array(profiles), return_inverse=True,
+                                                             return_counts=True)
+        order = np.argsort(group_of_row, kind='stable')
+        starts = np.cumsum(group_sizes) - group_sizes
+        lengths = np.frombuffer(lengths, dtype=np.int64)[order]
+        demands = np.frombuffer(demands, dtype=np.int64)[order]
+        weights = np.frombuffer(weights, dtype=np.float64)[order]
+
+        # Pack each profile; profiles are independent of each other
+        profile_names = profile_names.tolist()
+        profile_results = map(process_profile, profile_names, np.split(lengths, starts[1:]),
+                              np.split(demands, starts[1:]), weights[starts].tolist(),
+                              repeat(stock_length), repeat(cut_kerf))
 
         # Initialize lists for storing results
         all_final_data = []
@@ -191,29 +423,24 @@ def index():
         final_headers = None
         details_headers = None
 
-        # Process each profile group
-        for profile, group in parts_by_profile.items():
-            # Generate cutting patterns using best-fit algorithm
-            bins = best_fit_cutting_stock(group, stock_length, cut_kerf)
-            # Generate final report for this profile
-            agg_table, agg_headers = generate_final_report(group, bins, stock_length, cut_kerf, profile)
+        # Merge the per-profile tables in profile order
+        for profile, (agg_table, agg_headers, details_table, det_headers) in zip(profile_names, profile_results):
             if agg_table:
                 all_final_data.extend(agg_table)
             if not final_headers:
                 final_headers = agg_headers
 
-            # Generate pattern details table
-            details_table, det_headers = generate_pattern_details_table(bins, stock_length)
             if details_table:
                 all_details_data.append([f"Profile: {profile}", '', '', ''])
                 all_details_data.extend(details_table)
             if not details_headers:
                 details_headers = det_headers
 
-        # Generate Excel file in memory
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Cutting Stock Results"
+        # Generate Excel file; write-only mode streams rows out instead of keeping cell objects.
+        # openpyxl is imported here so GET requests and cached results never load it.
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Cutting Stock Results")
 
         # Write Final Aggregate Report to Excel
         ws.append(["--- Final Aggregate Report ---"])
@@ -228,40 +455,45 @@ def index():
         for row in all_details_data:
             ws.append(row)
 
-        # Save Excel to memory buffer
-        excel_buffer = io.BytesIO()
-        wb.save(excel_buffer)
-        excel_buffer.seek(0)
-
-        # Convert Excel bytes to base64 string for safe HTML transmission
-        excel_data = base64.b64encode(excel_buffer.getvalue()).decode('utf-8')
+        # Save Excel to disk; the page only carries the key to download it
+        prune_excel_files()
+        excel_key = uuid.uuid4().hex
+        wb.save(excel_path(excel_key))
 
         # Render the results template with all data
-        return render_template('results.html',
-                               final_data=all_final_data,  # Final report table data
-                               final_headers=final_headers,  # Final report headers
-                               details_data=all_details_data,  # Pattern details table data
-                               details_headers=details_headers,  # Pattern details headers
-                               excel_data=excel_data)  # Base64-encoded Excel file
+        results = dict(final_data=all_final_data,  # Final report table data
+                       final_headers=final_headers,  # Final report headers
+                       details_data=all_details_data,  # Pattern details table data
+                       details_headers=details_headers,  # Pattern details headers
+                       excel_key=excel_key)  # Key of the stored Excel file
+        results['payload'] = results_payload(results)  # Tables as embedded JSON for client-side rendering
+        cache_results(cache_key, results)
+        return render_results(results)
 
     # For GET requests, show the input form
     return render_template('index.html')
 
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    """Show the input form again when the upload exceeds MAX_CONTENT_LENGTH."""
+    max_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return render_template('index.html', error=f'File too large (max {max_mb} MB)'), 413
+
+
 @app.route('/download_excel')
 def download_excel():
     """
     Route handler for downloading the generated Excel file.
-    Takes the base64-encoded Excel data from the query parameter and sends it as a file.
+    Looks up the Excel file stored under the key from the query parameter and sends it.
     """
-    # Get the base64-encoded Excel data from URL parameters
-    excel_data = request.args.get('excel_data')
-
-    # Decode base64 string back to bytes
-    buffer = io.BytesIO(base64.b64decode(excel_data))
+    # Get the Excel key from URL parameters; it must be one we generated
+    excel_key = request.args.get('excel_key', '')
+    if not re.fullmatch(r'[0-9a-f]{32}', excel_key) or not os.path.exists(excel_path(excel_key)):
+        abort(404)
 
     # Send the file to the user as a download
-    return send_file(buffer,
+    return send_file(excel_path(excel_key),
                      download_name='cutting_stock_results.xlsx',  # File name for download
                      as_attachment=True,  # Force download instead of display
                      mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')  # Excel MIME type